@@ -1,32 +1,574 @@
-from flask import Flask, request, jsonify
 import os
+
+# --- gevent monkey-patching ---
+# Must happen before ccxt/requests are imported so their blocking socket calls
+# become cooperative. In production gunicorn's gevent worker (see Procfile)
+# patches before importing this module; USE_GEVENT=1 does it for `python app.py`.
+USE_GEVENT = os.getenv("USE_GEVENT") == "1"
+if USE_GEVENT:
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, request
+import sys
+import queue
+import atexit
+import logging
+import logging.handlers
 import ccxt
+import ccxt.pro as ccxtpro
+import asyncio
 import math
+import hmac
+import hashlib
+import orjson
+import msgspec
+import time
+import uuid
+import threading
+import functools
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from rq import Queue
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 app = Flask(__name__)
 
+# --- Logging ---
+# Request handlers only enqueue records; a single listener thread writes them to
+# stdout, so concurrent webhooks never contend for the stdout lock.
+logger = logging.getLogger('bot')
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+stdout_handler = logging.StreamHandler(sys.stdout)
+stdout_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, stdout_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+
 # --- Load Environment Variables ---
 API_KEY = os.getenv("API_KEY")
 API_SECRET = os.getenv("API_SECRET")
 SECRET_KEY = os.getenv("SECRET_KEY", "test1234")
+REDIS_URL = os.getenv("REDIS_URL")
+
+# --- Optional Redis connection (enabled by REDIS_URL) ---
+r = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# --- Market metadata cache, shared by all workers for a day ---
+# Stored as JSON rather than a pickle, since this process holds the API secret and
+# must not execute whatever is in Redis. Versioned on the ccxt release so an upgrade
+# never reads markets parsed by an older one.
+MARKETS_KEY = f"mkts:binance:fut:sbx:json:{ccxt.__version__}"
+MARKETS_TTL = 86400
+
+def load_markets_cached(ex):
+    if r is not None:
+        try:
+            blob = r.get(MARKETS_KEY)
+            if blob:
+                ex.set_markets(orjson.loads(blob))
+                logger.info("Loaded markets from Redis cache.")
+                return
+        except (redis.RedisError, orjson.JSONDecodeError) as e:
+            logger.warning("Could not read cached markets: %s", e)
+    ex.load_markets()
+    if r is not None:
+        try:
+            r.set(MARKETS_KEY, orjson.dumps(ex.markets), ex=MARKETS_TTL)
+        except redis.RedisError as e:
+            logger.warning("Could not cache markets: %s", e)
+
+# --- Keep-alive connection pool for Binance HTTPS ---
+# Warm calls reuse pooled TLS connections; ccxt handles retries itself.
+def build_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=Retry(total=0))
+    session.mount('https://', adapter)
+    return session
+
+# --- Exchange Connection for Binance Futures Testnet ---
+# Built on first use rather than at import, so importing this module (tests, the
+# rq worker, the web process in queue mode) never touches the network.
+exchange_client = None
+exchange_lock = threading.Lock()
+
+def build_exchange():
+    if not API_KEY or not API_SECRET:
+        raise Exception("CRITICAL: Missing API_KEY or API_SECRET.")
+    try:
+        logger.info("Attempting to connect to Binance Futures Testnet...")
+        ex = ccxt.binance({
+            'apiKey': API_KEY,
+            'secret': API_SECRET,
+            'enableRateLimit': True,
+            'options': { 'defaultType': 'future' },
+            'session': build_http_session(),
+        })
+        ex.set_sandbox_mode(True)
+        load_markets_cached(ex)
+        logger.info("SUCCESS: Connection to Binance Futures Testnet established.")
+        return ex
+    except Exception as e:
+        raise Exception(f"Error initializing exchange connection: {e}")
+
+# Double-checked so simultaneous first alerts (and the balance refresher, price stream
+# and amount steps) share one client instead of each running load_markets. A failed
+# build leaves the client unset, so the next order retries it.
+def get_exchange():
+    global exchange_client
+    if exchange_client is None:
+        with exchange_lock:
+            if exchange_client is None:
+                exchange_client = build_exchange()
+    return exchange_client
+
+# --- Amount step size per market, computed once from the loaded markets ---
+# Webhooks send Binance ids ('ETHUSDT'), so linear markets are indexed by id too.
+def build_amount_steps(ex):
+    steps = {}
+    for m in ex.markets.values():
+        precision = (m.get('precision') or {}).get('amount')
+        if precision is None:
+            continue
+        step = precision if ex.precisionMode == ccxt.TICK_SIZE else 10 ** -precision
+        steps[m['symbol']] = step
+        if m.get('linear'):
+            steps[m['id']] = step
+    return steps
+
+@functools.lru_cache(maxsize=1)
+def amount_steps():
+    return build_amount_steps(get_exchange())
+
+def floor_to_step(amount, step):
+    # The epsilon keeps float error (0.3 / 0.1 == 2.999...) from dropping a whole step.
+    return round(math.floor(amount / step + 1e-9) * step, 12)
+
+# --- Short-lived cache for hot-path exchange reads ---
+TICKER_TTL = 1
+BALANCE_TTL = 2
+POSITIONS_TTL = 1
+CACHE_LOCK_TTL = 2
+
+# Deletes a lock only while it still holds the caller's token, so a load that outlived
+# CACHE_LOCK_TTL can't release a lock another worker has claimed since.
+RELEASE_LOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Writes a loaded value back only if the key's generation is unchanged since the load
+# started (an order bumps it via cache_invalidate), then releases the lock as above.
+STORE_LUA = """
+if (redis.call('get', KEYS[3]) or '') == ARGV[2] then
+    redis.call('set', KEYS[1], ARGV[3], 'EX', ARGV[4])
+end
+if redis.call('get', KEYS[2]) == ARGV[1] then
+    redis.call('del', KEYS[2])
+end
+return 0
+"""
+CACHE_GENERATION_TTL = 3600
+
+# Script objects (and their SHAs) are built once, on the first cache miss. They are
+# always run with client=pipe, so they don't depend on which client registered them.
+cache_scripts = {}
+
+def cache_script(source):
+    script = cache_scripts.get(source)
+    if script is None:
+        script = cache_scripts[source] = r.register_script(source)
+    return script
+
+def cache_get_or_set(key, ttl, loader):
+    return cache_get_many({key: (ttl, loader)})[key]
+
+# specs maps key -> (ttl, loader). Hits cost one MGET; misses are claimed with one
+# pipelined round of lock SETNXs, loaded concurrently, and written back in one more.
+def cache_get_many(specs):
+    keys = list(specs)
+    if r is None:
+        return _load_direct(keys, specs)
+    try:
+        blobs = r.mget(keys)
+    except redis.RedisError as e:
+        logger.warning("Redis unavailable, reading from exchange directly: %s", e)
+        return _load_direct(keys, specs)
+    values = {k: orjson.loads(blob) for k, blob in zip(keys, blobs) if blob is not None}
+    missing = [k for k in keys if k not in values]
+    if missing:
+        values.update(_load_missing(missing, specs))
+    return values
+
+def _load_direct(keys, specs):
+    return dict(zip(keys, fetch_concurrently(*(specs[k][1] for k in keys))))
+
+def _load_missing(keys, specs):
+    token = uuid.uuid4().hex
+    try:
+        pipe = r.pipeline(transaction=False)
+        for k in keys:
+            pipe.set(f"lock:{k}", token, nx=True, ex=CACHE_LOCK_TTL)
+            pipe.get(f"gen:{k}")
+        replies = pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Redis unavailable, reading from exchange directly: %s", e)
+        return _load_direct(keys, specs)
+
+    # Only the worker holding a key's lock hits Binance; the rest wait for its result.
+    claimed = replies[0::2]
+    generations = {k: gen or b"" for k, gen in zip(keys, replies[1::2])}
+    owned = [k for k, ok in zip(keys, claimed) if ok]
+    waiting = [k for k, ok in zip(keys, claimed) if not ok]
+    values = {}
+    if owned:
+        try:
+            values.update(_load_direct(owned, specs))
+        finally:
+            try:
+                store = cache_script(STORE_LUA)
+                release_lock = cache_script(RELEASE_LOCK_LUA)
+                pipe = r.pipeline(transaction=False)
+                for k in owned:
+                    if k in values:
+                        store(
+                            keys=[k, f"lock:{k}", f"gen:{k}"],
+                            args=[token, generations[k], orjson.dumps(values[k], default=str), specs[k][0]],
+                            client=pipe,
+                        )
+                    else:
+                        release_lock(keys=[f"lock:{k}"], args=[token], client=pipe)
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning("Could not write cache keys %s: %s", owned, e)
+
+    # A holder can release its lock without writing (its loader raised, or an order
+    # invalidated the key mid-load); such keys are loaded here straight away.
+    deadline = time.monotonic() + CACHE_LOCK_TTL
+    while waiting and time.monotonic() < deadline:
+        time.sleep(0.05)
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.mget(waiting)
+            for k in waiting:
+                pipe.exists(f"lock:{k}")
+            blobs, *locked = pipe.execute()
+        except redis.RedisError:
+            break
+        released = []
+        for k, blob, held in zip(waiting, blobs, locked):
+            if blob is not None:
+                values[k] = orjson.loads(blob)
+            elif not held:
+                released.append(k)
+        if released:
+            values.update(_load_direct(released, specs))
+        waiting = [k for k in waiting if k not in values]
+    if waiting:
+        values.update(_load_direct(waiting, specs))
+    return values
+
+def cache_invalidate(*keys):
+    if r is None:
+        return
+    # Bumping the generation stops loads already in flight from writing back pre-order data.
+    try:
+        pipe = r.pipeline(transaction=False)
+        pipe.delete(*keys)
+        for k in keys:
+            pipe.incr(f"gen:{k}")
+            pipe.expire(f"gen:{k}", CACHE_GENERATION_TTL)
+        pipe.execute()
+    except redis.RedisError as e:
+        logger.warning("Could not invalidate cache keys %s: %s", keys, e)
+
+def load_free_usdt():
+    return get_exchange().fetch_balance()['free'].get("USDT", 0)
+
+# ccxt only filters `symbols` client-side; the `symbol` param makes Binance return
+# just this market's position.
+def load_positions(symbol):
+    exchange = get_exchange()
+    return exchange.fetch_positions([symbol], {'symbol': exchange.market(symbol)['id']})
+
+def fetch_positions_cached(symbol):
+    return cache_get_or_set(f"pos:{symbol}", POSITIONS_TTL, lambda: load_positions(symbol))
+
+# --- Background balance refresher ---
+# Seeded synchronously by the first BUY in whichever process places orders (web or
+# rq worker), then kept fresh in the background, so BUY sizing normally needs no
+# network I/O. Threads are greenlets under gevent.
+BALANCE_REFRESH_SECS = 1
+BALANCE_MAX_AGE = 5
+LAST_BALANCE = {'USDT': None, 'ts': 0.0, 'generation': 0}
+balance_lock = threading.Lock()
+balance_refresher = None
+
+def refresh_balance():
+    # A fetch that overlaps an order may return the pre-trade balance, so its result
+    # is dropped if mark_balance_stale() ran while it was in flight.
+    with balance_lock:
+        generation = LAST_BALANCE['generation']
+    started = time.monotonic()
+    free = load_free_usdt()
+    with balance_lock:
+        if LAST_BALANCE['generation'] != generation:
+            return
+        LAST_BALANCE['USDT'] = free
+        LAST_BALANCE['ts'] = started
+
+def _refresh_balance_loop():
+    while True:
+        time.sleep(BALANCE_REFRESH_SECS)
+        try:
+            refresh_balance()
+        except Exception as e:
+            logger.warning("Balance refresh failed: %s", e)
+
+def start_balance_refresher():
+    global balance_refresher
+    with balance_lock:
+        if balance_refresher is None:
+            balance_refresher = threading.Thread(target=_refresh_balance_loop, daemon=True)
+            balance_refresher.start()
+
+def mark_balance_stale():
+    with balance_lock:
+        LAST_BALANCE['generation'] += 1
+        LAST_BALANCE['ts'] = 0.0
+
+# Returns None when the refreshed value is too old to size an order from.
+def refreshed_free_usdt():
+    if balance_refresher is None:
+        refresh_balance()
+        start_balance_refresher()
+    with balance_lock:
+        free, ts = LAST_BALANCE['USDT'], LAST_BALANCE['ts']
+    if free is not None and time.monotonic() - ts <= BALANCE_MAX_AGE:
+        return free
+    return None
+
+# --- Streaming last prices (ccxt.pro watch_ticker) ---
+# Each listed symbol is subscribed on its first BUY; later BUYs size from the streamed
+# price and only fall back to fetch_ticker when it is missing or stale.
+PRICE_STREAM = os.getenv("PRICE_STREAM", "1") == "1"
+
+# An asyncio loop run inside a greenlet counts as the running loop in every other
+# greenlet too, which breaks asyncio elsewhere in the process. The stream therefore
+# only runs in unpatched processes (the rq worker, DEV), never under gevent.
+def price_stream_enabled():
+    monkey = sys.modules.get("gevent.monkey")
+    patched = monkey is not None and monkey.is_module_patched("threading")
+    return PRICE_STREAM and not patched
+PRICE_MAX_AGE = 5
+LAST_PRICE = {}
+price_lock = threading.Lock()
+price_loop = None
+ws_exchange = None
+watched_symbols = set()
 
-if not API_KEY or not API_SECRET:
-    raise Exception("CRITICAL: Missing API_KEY or API_SECRET.")
-
-# --- Initialize Exchange Connection for Binance Futures Testnet ---
-try:
-    print("Attempting to connect to Binance Futures Testnet...")
-    exchange = ccxt.binance({
-        'apiKey': API_KEY,
-        'secret': API_SECRET,
-        'enableRateLimit': True,
-        'options': { 'defaultType': 'future' }
+async def _watch_price(symbol):
+    while True:
+        try:
+            ticker = await ws_exchange.watch_ticker(symbol)
+            if ticker.get('last') is not None:
+                LAST_PRICE[symbol] = (ticker['last'], time.monotonic())
+        except ccxt.BadSymbol as e:
+            logger.warning("Price stream for %s stopped: %s", symbol, e)
+            with price_lock:
+                watched_symbols.discard(symbol)
+            return
+        except Exception as e:
+            logger.warning("Price stream for %s failed, resubscribing: %s", symbol, e)
+            await asyncio.sleep(1)
+
+# Only listed markets are subscribed, so a mistyped alert symbol can't leave a
+# stream retrying forever, and the set of streams is bounded by the market list.
+def watch_price(symbol):
+    global price_loop, ws_exchange
+    exchange = get_exchange()
+    if symbol not in exchange.markets and symbol not in (exchange.markets_by_id or {}):
+        return
+    with price_lock:
+        if symbol in watched_symbols:
+            return
+        if price_loop is None:
+            ws_exchange = ccxtpro.binance({'options': { 'defaultType': 'future' }})
+            ws_exchange.set_sandbox_mode(True)
+            ws_exchange.set_markets(exchange.markets)
+            price_loop = asyncio.new_event_loop()
+            threading.Thread(target=price_loop.run_forever, daemon=True).start()
+        watched_symbols.add(symbol)
+    asyncio.run_coroutine_threadsafe(_watch_price(symbol), price_loop)
+
+def streamed_price(symbol):
+    if not price_stream_enabled():
+        return None
+    watch_price(symbol)
+    entry = LAST_PRICE.get(symbol)
+    if entry is not None and time.monotonic() - entry[1] <= PRICE_MAX_AGE:
+        return entry[0]
+    return None
+
+# --- Overlap independent Binance REST calls ---
+# Threads become greenlets under gevent, so this works with both servers.
+io_pool = ThreadPoolExecutor(max_workers=8)
+
+def fetch_concurrently(*calls):
+    futures = [io_pool.submit(call) for call in calls]
+    return [f.result() for f in futures]
+
+# --- Duplicate alert suppression ---
+IDEMPOTENCY_BUCKET_SECS = 5
+IDEMPOTENCY_TTL = 10
+
+def is_duplicate_alert(symbol, side, action, qty_pct):
+    if r is None:
+        return False
+    fingerprint = orjson.dumps({
+        's': symbol, 'd': side, 'a': action, 'q': qty_pct,
+        't': int(time.time() // IDEMPOTENCY_BUCKET_SECS),
     })
-    exchange.set_sandbox_mode(True)
-    exchange.load_markets()
-    print("SUCCESS: Connection to Binance Futures Testnet established.")
-except Exception as e:
-    raise Exception(f"Error initializing exchange connection: {e}")
+    key = "idem:" + hashlib.blake2b(fingerprint, digest_size=16).hexdigest()
+    try:
+        return not r.set(key, "1", nx=True, ex=IDEMPOTENCY_TTL)
+    except redis.RedisError as e:
+        logger.warning("Could not check alert idempotency, processing anyway: %s", e)
+        return False
+
+# --- Order execution (runs in the rq worker when REDIS_URL is set) ---
+ORDER_JOB_TIMEOUT = 30
+# A market order placed long after its alert fires at whatever the price is by then,
+# so queued alerts that no worker picks up within this window are dropped.
+ORDER_QUEUE_TTL = 30
+ORDER_RESULT_TTL = 86400
+ORDER_FAILURE_TTL = 7 * 86400
+order_queue = Queue("orders", connection=r) if r is not None else None
+
+def _do_buy(symbol, qty_pct):
+    logger.info("Processing BUY order for %s...", symbol)
+    exchange = get_exchange()
+    # Balance and price normally come from memory; only stale values hit Redis/Binance.
+    ticker_key = f"tkr:{symbol}"
+    specs = {}
+    last_price = streamed_price(symbol)
+    if last_price is None:
+        specs[ticker_key] = (TICKER_TTL, lambda: exchange.fetch_ticker(symbol))
+    available_balance = refreshed_free_usdt()
+    if available_balance is None:
+        specs["bal:USDT"] = (BALANCE_TTL, load_free_usdt)
+    cached = cache_get_many(specs) if specs else {}
+    if available_balance is None:
+        available_balance = cached["bal:USDT"]
+
+    quote_currency = "USDT"
+    logger.info("Available balance: %s %s", available_balance, quote_currency)
+    if available_balance <= 1:
+        return {"status": "error", "message": f"Insufficient balance."}, 400
+
+    if last_price is None:
+        last_price = cached[ticker_key].get('last')
+    if last_price is None:
+        return {"status": "error", "message": f"Could not get price for {symbol}."}, 400
+
+    amount_in_usdt = available_balance * (qty_pct / 100)
+    step = amount_steps().get(symbol, 1e-6)
+    amount = floor_to_step(amount_in_usdt / last_price, step)
+    if amount <= 0:
+        return {"status": "error", "message": f"Order size is below the minimum step of {step} for {symbol}."}, 400
+
+    logger.info("Attempting to place market BUY order for %.4f %s at ~$%s", amount, symbol, last_price)
+    order = exchange.create_market_buy_order(symbol, amount)
+    cache_invalidate("bal:USDT", f"pos:{symbol}")
+    mark_balance_stale()
+    logger.info("SUCCESS: Buy Order executed.")
+    return {"status": "success", "order": order}, 200
+
+# Keyed by both the Binance id ('ETHUSDT') and the unified symbol, so either form resolves.
+def _index_positions(positions):
+    index = {}
+    for p in positions:
+        index[p['symbol']] = p
+        index[p['info']['symbol']] = p
+    return index
+
+def _do_close(symbol):
+    logger.info("Processing CLOSE signal for %s...", symbol)
+    exchange = get_exchange()
+
+    pos = _index_positions(fetch_positions_cached(symbol)).get(symbol)
+    amt = float(pos['info']['positionAmt']) if pos else 0.0
+
+    if amt == 0:
+        logger.info("No open position found to close for %s.", symbol)
+        return {"status": "info", "message": "No open position to close"}, 200
+
+    qty_to_close = abs(amt)
+    side_to_close = 'sell' if amt > 0 else 'buy'
+
+    logger.info("Open position found: %s %s. Placing market %s order for %s to close.", amt, symbol, side_to_close.upper(), qty_to_close)
+
+    if side_to_close == 'sell':
+        order = exchange.create_market_sell_order(symbol, qty_to_close, {'reduceOnly': True})
+    else: # side_to_close == 'buy'
+        order = exchange.create_market_buy_order(symbol, qty_to_close, {'reduceOnly': True})
+    cache_invalidate("bal:USDT", f"pos:{symbol}")
+    mark_balance_stale()
+
+    logger.info("SUCCESS: Close Order executed.")
+    return {"status": "success", "order": order}, 200
+
+def execute_order(kind, symbol, qty_pct=0):
+    try:
+        if kind == "buy":
+            payload, code = _do_buy(symbol, qty_pct)
+        else:
+            payload, code = _do_close(symbol)
+    except ccxt.BaseError as e:
+        logger.error("CCXT: An error occurred with the exchange: %s", e)
+        payload, code = {"status": "error", "message": str(e)}, 500
+    except Exception as e:
+        logger.exception("An unexpected error occurred: %s", e)
+        payload, code = {"status": "error", "message": str(e)}, 500
+
+    # Results of queued orders are announced on the 'orders' channel for observability.
+    if r is not None:
+        try:
+            r.publish("orders", orjson.dumps({"kind": kind, "symbol": symbol, "code": code, **payload}))
+        except redis.RedisError as e:
+            logger.warning("Could not publish order result: %s", e)
+    return payload, code
+
+class OrderFailed(Exception):
+    pass
+
+# rq entry point: orders that did not succeed are raised so rq records them as
+# failed jobs (kept for ORDER_FAILURE_TTL) instead of finished ones.
+def order_job(kind, symbol, qty_pct=0):
+    payload, code = execute_order(kind, symbol, qty_pct)
+    if code >= 400:
+        raise OrderFailed(f"{kind} {symbol} failed ({code}): {payload.get('message')}")
+    return payload
+
+# --- Webhook payload ---
+# Decoded and validated in one pass; strict=False lets TradingView send qty_pct as "25".
+class Alert(msgspec.Struct):
+    secret: Optional[str] = None
+    symbol: Optional[str] = None
+    side: Optional[str] = None
+    action: Optional[str] = None
+    qty_pct: float = 0.0
+
+def j(payload, code=200):
+    return Response(orjson.dumps(payload), status=code, mimetype='application/json')
 
 @app.route('/')
 def home():
@@ -34,101 +576,69 @@ def home():
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    try:
-        data = request.get_json(force=True)
-        print(f"Webhook received: {data}")
-    except Exception as e:
-        return jsonify({"status": "error", "message": f"Invalid JSON: {e}"}), 400
+    raw = request.get_data()
 
-    if data.get("secret") != SECRET_KEY:
-        return jsonify({"status": "error", "message": "Invalid secret key"}), 403
+    # Signed requests are authenticated before the body is parsed at all.
+    signature = request.headers.get('X-Signature')
+    if signature is not None:
+        expected = hmac.new(SECRET_KEY.encode(), raw, hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(signature.encode(), expected.encode()):
+            return j({"status": "error", "message": "Invalid signature"}, 403)
 
-    symbol = data.get("symbol") # This will be 'ETHUSDT' from your webhook
-    side = data.get("side")
-    action = data.get("action")
     try:
-        qty_pct = float(data.get("qty_pct", 0))
-    except (ValueError, TypeError):
-        qty_pct = 0
+        alert = msgspec.json.decode(raw, type=Alert, strict=False)
+        logger.info("Webhook received: symbol=%s side=%s action=%s qty_pct=%s", alert.symbol, alert.side, alert.action, alert.qty_pct)
+    except msgspec.DecodeError as e:
+        return j({"status": "error", "message": f"Invalid payload: {e}"}, 400)
+
+    # Unsigned requests (e.g. plain TradingView alerts) fall back to the body secret.
+    # A missing secret never matches, even when SECRET_KEY is set to an empty string.
+    if signature is None and (alert.secret is None or not hmac.compare_digest(alert.secret.encode(), SECRET_KEY.encode())):
+        return j({"status": "error", "message": "Invalid secret key"}, 403)
+
+    symbol = alert.symbol # This will be 'ETHUSDT' from your webhook
+    side = alert.side
+    action = alert.action
+    qty_pct = alert.qty_pct
 
     if not symbol:
-        return jsonify({"status": "error", "message": "Missing 'symbol' in webhook data"}), 400
+        return j({"status": "error", "message": "Missing 'symbol' in webhook data"}, 400)
 
-    try:
-        # --- BUY LOGIC (No changes needed here) ---
-        if side == "buy":
-            print(f"Processing BUY order for {symbol}...")
-            balance = exchange.fetch_balance()
-            quote_currency = "USDT"
-            available_balance = balance['free'].get(quote_currency, 0)
-            print(f"Available balance: {available_balance} {quote_currency}")
-            if available_balance <= 1:
-                return jsonify({"status": "error", "message": f"Insufficient balance."}), 400
-            
-            ticker = exchange.fetch_ticker(symbol)
-            last_price = ticker.get('last')
-            if last_price is None:
-                return jsonify({"status": "error", "message": f"Could not get price for {symbol}."}), 400
-
-            amount_in_usdt = available_balance * (qty_pct / 100)
-            amount = amount_in_usdt / last_price
-            
-            print(f"Attempting to place market BUY order for {amount:.4f} {symbol} at ~${last_price}")
-            order = exchange.create_market_buy_order(symbol, amount)
-            print(f"SUCCESS: Buy Order executed.")
-            return jsonify({"status": "success", "order": order}), 200
-
-        # --- CLOSE LOGIC (FINAL, REVISED VERSION WITH THE FIX) ---
-        elif action == "close":
-            print(f"Processing CLOSE signal for {symbol}...")
-            
-            all_positions = exchange.fetch_positions()
-            
-            print(f"--- DEBUG: All positions fetched: {all_positions} ---")
-            
-            pos = None
-            for p in all_positions:
-                p_info_symbol = p.get('info', {}).get('symbol')
-                # *** FIX APPLIED HERE: Access positionAmt from within 'info' dictionary ***
-                p_position_amt_str = p.get('info', {}).get("positionAmt", "0") 
-                try:
-                    p_position_amt = float(p_position_amt_str)
-                except ValueError:
-                    p_position_amt = 0.0 # Handle cases where positionAmt might not be a valid number
-                
-                print(f"--- DEBUG Check: Comparing webhook symbol '{symbol}' with position symbol '{p_info_symbol}' and position amount '{p_position_amt_str}' (float: {p_position_amt}) ---")
-                
-                if p_info_symbol == symbol and p_position_amt != 0:
-                    print(f"--- DEBUG Match Found! Position: {p} ---")
-                    pos = p
-                    break # Found the relevant position, exit loop
-            
-            if pos:
-                qty_to_close = abs(float(pos.get('info', {}).get("positionAmt", 0))) # Also update this to use 'info'
-                side_to_close = 'sell' if float(pos.get('info', {}).get("positionAmt")) > 0 else 'buy' # And this
-                
-                print(f"Open position found: {pos.get('info', {}).get('positionAmt')} {symbol}. Placing market {side_to_close.upper()} order for {qty_to_close} to close.")
-                
-                if side_to_close == 'sell':
-                    order = exchange.create_market_sell_order(symbol, qty_to_close, {'reduceOnly': True})
-                else: # side_to_close == 'buy'
-                    order = exchange.create_market_buy_order(symbol, qty_to_close, {'reduceOnly': True})
-                
-                print(f"SUCCESS: Close Order executed.")
-                return jsonify({"status": "success", "order": order}), 200
-            else:
-                print("Info: No open position found to close for this symbol.")
-                return jsonify({"status": "info", "message": "No open position to close"}), 200
-        else:
-            return jsonify({"status": "error", "message": "Invalid side/action"}), 400
+    if is_duplicate_alert(symbol, side, action, qty_pct):
+        logger.info("Duplicate alert for %s ignored.", symbol)
+        return j({"status": "dup"}, 200)
 
-    except ccxt.BaseError as e:
-        print(f"ERROR (CCXT): An error occurred with the exchange: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-    except Exception as e:
-        print(f"ERROR (General): An unexpected error occurred: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+    if side == "buy":
+        job_args = ("buy", symbol, qty_pct)
+    elif action == "close":
+        job_args = ("close", symbol)
+    else:
+        return j({"status": "error", "message": "Invalid side/action"}, 400)
+
+    # Ack immediately so a slow Binance response never trips TradingView's timeout.
+    if order_queue is not None:
+        try:
+            job = order_queue.enqueue(
+                order_job, *job_args,
+                job_timeout=ORDER_JOB_TIMEOUT,
+                ttl=ORDER_QUEUE_TTL,
+                result_ttl=ORDER_RESULT_TTL,
+                failure_ttl=ORDER_FAILURE_TTL,
+            )
+            return j({"status": "queued", "job": job.id}, 202)
+        except redis.RedisError as e:
+            logger.warning("Could not enqueue order, executing inline: %s", e)
+
+    payload, code = execute_order(*job_args)
+    return j(payload, code)
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    if USE_GEVENT:
+        from gevent.pywsgi import WSGIServer
+        logger.info("Starting gevent WSGIServer on port %s...", port)
+        WSGIServer(("0.0.0.0", port), app).serve_forever()
+    elif os.getenv("DEV"):
+        app.run(host="0.0.0.0", port=port)
+    else:
+        raise SystemExit("Run under gunicorn (see Procfile), or set DEV=1 for the Flask development server or USE_GEVENT=1 for gevent's WSGIServer.")
@@ -0,0 +1,73 @@
+import os
+import sys
+
+import ccxt
+import fakeredis
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as bot
+
+
+class FakeExchange:
+    precisionMode = ccxt.TICK_SIZE
+
+    def __init__(self):
+        self.markets = {
+            'ETH/USDT:USDT': {'symbol': 'ETH/USDT:USDT', 'id': 'ETHUSDT', 'linear': True, 'precision': {'amount': 0.001}},
+        }
+        self.markets_by_id = {'ETHUSDT': [self.markets['ETH/USDT:USDT']]}
+        self.free_usdt = 1000
+        self.last = 2000.0
+        self.position_amt = "0"
+        self.orders = []
+        self.position_params = None
+
+    def market(self, symbol):
+        if symbol in self.markets:
+            return self.markets[symbol]
+        return self.markets_by_id[symbol][0]
+
+    def fetch_balance(self):
+        return {'free': {'USDT': self.free_usdt}}
+
+    def fetch_ticker(self, symbol):
+        return {'last': self.last}
+
+    def fetch_positions(self, symbols, params=None):
+        self.position_params = params
+        return [{'symbol': 'ETH/USDT:USDT', 'info': {'symbol': 'ETHUSDT', 'positionAmt': self.position_amt}}]
+
+    def create_market_buy_order(self, symbol, amount, params=None):
+        self.orders.append(('buy', symbol, amount, params))
+        return {'side': 'buy', 'amount': amount}
+
+    def create_market_sell_order(self, symbol, amount, params=None):
+        self.orders.append(('sell', symbol, amount, params))
+        return {'side': 'sell', 'amount': amount}
+
+
+@pytest.fixture
+def exchange(monkeypatch):
+    ex = FakeExchange()
+    monkeypatch.setattr(bot, "get_exchange", lambda: ex)
+    monkeypatch.setattr(bot, "amount_steps", lambda: bot.build_amount_steps(ex))
+    monkeypatch.setattr(bot, "PRICE_STREAM", False)
+    monkeypatch.setattr(bot, "LAST_BALANCE", {'USDT': None, 'ts': 0.0, 'generation': 0})
+    monkeypatch.setattr(bot, "start_balance_refresher", lambda: None)
+    monkeypatch.setattr(bot, "balance_refresher", object())
+    return ex
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    client = fakeredis.FakeRedis()
+    monkeypatch.setattr(bot, "r", client)
+    return client
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(bot, "SECRET_KEY", "s3cret")
+    return bot.app.test_client()
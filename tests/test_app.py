@@ -0,0 +1,289 @@
+import hashlib
+import hmac
+import threading
+import time
+
+import ccxt
+import fakeredis
+import orjson
+import pytest
+from rq import Queue
+
+import app as bot
+
+
+def sign(body, key="s3cret"):
+    return hmac.new(key.encode(), body, hashlib.sha256).hexdigest()
+
+
+# --- Order sizing ---
+
+def test_concurrent_first_calls_build_one_exchange(monkeypatch):
+    builds = []
+    def slow_build():
+        builds.append(1)
+        time.sleep(0.05)
+        return object()
+    monkeypatch.setattr(bot, "build_exchange", slow_build)
+    monkeypatch.setattr(bot, "exchange_client", None)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(bot.get_exchange())) for _ in range(5)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(builds) == 1
+    assert len({id(x) for x in results}) == 1
+
+
+def test_failed_exchange_build_is_retried(monkeypatch):
+    def failing_build():
+        raise Exception("down")
+    monkeypatch.setattr(bot, "build_exchange", failing_build)
+    monkeypatch.setattr(bot, "exchange_client", None)
+    with pytest.raises(Exception, match="down"):
+        bot.get_exchange()
+    assert bot.exchange_client is None
+
+
+class MarketsExchange:
+    def __init__(self):
+        self.markets = None
+        self.loads = 0
+
+    def load_markets(self):
+        self.loads += 1
+        self.markets = {'ETH/USDT:USDT': {'id': 'ETHUSDT', 'precision': {'amount': 0.001}}}
+
+    def set_markets(self, markets):
+        self.markets = markets
+
+
+def test_markets_are_shared_through_redis_as_json(fake_redis):
+    first = MarketsExchange()
+    bot.load_markets_cached(first)
+    assert orjson.loads(fake_redis.get(bot.MARKETS_KEY)) == first.markets
+
+    second = MarketsExchange()
+    bot.load_markets_cached(second)
+    assert second.loads == 0
+    assert second.markets == first.markets
+
+
+def test_unreadable_cached_markets_are_reloaded(fake_redis):
+    fake_redis.set(bot.MARKETS_KEY, b'\x80\x05not json')
+    ex = MarketsExchange()
+    bot.load_markets_cached(ex)
+    assert ex.loads == 1
+
+
+def test_floor_to_step_rounds_down_without_float_drift():
+    assert bot.floor_to_step(0.3, 0.1) == 0.3
+    assert bot.floor_to_step(0.0839, 0.001) == 0.083
+    assert bot.floor_to_step(0.0009, 0.001) == 0
+
+
+def test_build_amount_steps_tick_size_mode(exchange):
+    exchange.markets['ETH/USDT'] = {'symbol': 'ETH/USDT', 'id': 'ETHUSDT', 'linear': None, 'precision': {'amount': 0.0001}}
+    steps = bot.build_amount_steps(exchange)
+    assert steps['ETH/USDT:USDT'] == 0.001
+    assert steps['ETH/USDT'] == 0.0001
+    # The id resolves to the futures market, not the spot one.
+    assert steps['ETHUSDT'] == 0.001
+
+
+def test_build_amount_steps_decimal_places_mode(exchange):
+    exchange.precisionMode = ccxt.DECIMAL_PLACES
+    exchange.markets['ETH/USDT:USDT']['precision']['amount'] = 3
+    exchange.markets['BAD/USDT:USDT'] = {'symbol': 'BAD/USDT:USDT', 'id': 'BADUSDT', 'linear': True, 'precision': {}}
+    steps = bot.build_amount_steps(exchange)
+    assert abs(steps['ETHUSDT'] - 0.001) < 1e-12
+    assert 'BADUSDT' not in steps
+
+
+def test_index_positions_by_id_and_unified_symbol():
+    pos = {'symbol': 'ETH/USDT:USDT', 'info': {'symbol': 'ETHUSDT', 'positionAmt': '1'}}
+    index = bot._index_positions([pos])
+    assert index['ETHUSDT'] is pos
+    assert index['ETH/USDT:USDT'] is pos
+
+
+def test_positions_are_filtered_by_binance(exchange):
+    bot.load_positions('ETHUSDT')
+    assert exchange.position_params == {'symbol': 'ETHUSDT'}
+
+
+# --- Redis cache ---
+
+def test_cache_without_redis_calls_loaders(monkeypatch):
+    monkeypatch.setattr(bot, "r", None)
+    assert bot.cache_get_many({'a': (5, lambda: 1), 'b': (5, lambda: 2)}) == {'a': 1, 'b': 2}
+
+
+def test_cache_hit_skips_loader(fake_redis):
+    fake_redis.set('a', orjson.dumps({'x': 1}))
+    assert bot.cache_get_or_set('a', 5, lambda: 1 / 0) == {'x': 1}
+
+
+def test_cache_miss_stores_value_and_releases_lock(fake_redis):
+    assert bot.cache_get_many({'a': (5, lambda: 1), 'b': (5, lambda: {'y': 2})}) == {'a': 1, 'b': {'y': 2}}
+    assert orjson.loads(fake_redis.get('b')) == {'y': 2}
+    assert 0 < fake_redis.ttl('a') <= 5
+    assert fake_redis.get('lock:a') is None
+
+
+def test_cache_waits_for_lock_holder(fake_redis):
+    fake_redis.set('lock:a', 'other-worker')
+    threading.Timer(0.1, lambda: fake_redis.set('a', orjson.dumps(42))).start()
+    assert bot.cache_get_or_set('a', 5, lambda: 1 / 0) == 42
+
+
+def test_cache_loads_directly_when_lock_holder_never_writes(fake_redis, monkeypatch):
+    monkeypatch.setattr(bot, "CACHE_LOCK_TTL", 0.2)
+    fake_redis.set('lock:a', 'other-worker')
+    assert bot.cache_get_or_set('a', 5, lambda: 7) == 7
+    assert fake_redis.get('lock:a') == b'other-worker'
+
+
+def test_cache_stops_waiting_when_lock_is_released_without_a_write(fake_redis):
+    fake_redis.set('lock:bal:USDT', 'other-worker')
+    threading.Timer(0.1, lambda: fake_redis.delete('lock:bal:USDT')).start()
+    started = time.monotonic()
+    assert bot.cache_get_or_set('bal:USDT', 5, lambda: 9) == 9
+    assert time.monotonic() - started < bot.CACHE_LOCK_TTL / 2
+
+
+def test_cache_does_not_release_a_lock_it_no_longer_owns(fake_redis):
+    def slow_loader():
+        # Our lock expired mid-load and another worker claimed it.
+        fake_redis.set('lock:a', 'other-worker')
+        return 1
+    assert bot.cache_get_or_set('a', 5, slow_loader) == 1
+    assert fake_redis.get('lock:a') == b'other-worker'
+
+
+def test_cache_skips_write_back_when_invalidated_during_load(fake_redis):
+    def loader():
+        bot.cache_invalidate('bal:USDT')
+        return 500
+    assert bot.cache_get_or_set('bal:USDT', 5, loader) == 500
+    assert fake_redis.get('bal:USDT') is None
+    assert bot.cache_get_or_set('bal:USDT', 5, lambda: 400) == 400
+    assert orjson.loads(fake_redis.get('bal:USDT')) == 400
+
+
+def test_cache_scripts_are_registered_once(fake_redis):
+    bot.cache_get_or_set('a', 5, lambda: 1)
+    store = bot.cache_script(bot.STORE_LUA)
+    bot.cache_get_or_set('b', 5, lambda: 2)
+    assert bot.cache_script(bot.STORE_LUA) is store
+
+
+def test_cache_falls_back_when_redis_is_down(monkeypatch):
+    server = fakeredis.FakeServer()
+    server.connected = False
+    monkeypatch.setattr(bot, "r", fakeredis.FakeRedis(server=server))
+    assert bot.cache_get_or_set('a', 5, lambda: 3) == 3
+
+
+# --- Balance refresher ---
+
+def test_first_buy_seeds_balance_once(exchange, monkeypatch):
+    calls = []
+    monkeypatch.setattr(bot, "load_free_usdt", lambda: calls.append(1) or 800)
+    monkeypatch.setattr(bot, "balance_refresher", None)
+    assert bot.refreshed_free_usdt() == 800
+    assert calls == [1]
+
+
+def test_refresh_overlapping_an_order_is_dropped(exchange, monkeypatch):
+    def fetch_during_order():
+        bot.mark_balance_stale()
+        return 1000
+    monkeypatch.setattr(bot, "load_free_usdt", fetch_during_order)
+    bot.refresh_balance()
+    assert bot.refreshed_free_usdt() is None
+
+
+# --- Webhook ---
+
+def test_body_secret_is_accepted(client, exchange):
+    resp = client.post('/webhook', data=orjson.dumps({'secret': 's3cret', 'symbol': 'ETHUSDT', 'side': 'buy', 'qty_pct': '10'}))
+    assert resp.status_code == 200
+    assert exchange.orders == [('buy', 'ETHUSDT', 0.05, None)]
+
+
+def test_wrong_body_secret_is_rejected(client, exchange):
+    resp = client.post('/webhook', data=orjson.dumps({'secret': 'nope', 'symbol': 'ETHUSDT', 'side': 'buy'}))
+    assert resp.status_code == 403
+    assert exchange.orders == []
+
+
+def test_missing_secret_is_rejected_even_with_empty_key(client, monkeypatch):
+    monkeypatch.setattr(bot, "SECRET_KEY", "")
+    resp = client.post('/webhook', data=orjson.dumps({'symbol': 'ETHUSDT', 'side': 'buy'}))
+    assert resp.status_code == 403
+
+
+def test_hmac_signature_is_checked_before_parsing(client):
+    resp = client.post('/webhook', data=b'not json', headers={'X-Signature': 'bad'})
+    assert resp.status_code == 403
+    resp = client.post('/webhook', data=b'not json', headers={'X-Signature': sign(b'not json')})
+    assert resp.status_code == 400
+
+
+def test_signed_close_reduces_open_position(client, exchange):
+    exchange.position_amt = "-0.5"
+    body = orjson.dumps({'symbol': 'ETHUSDT', 'action': 'close'})
+    resp = client.post('/webhook', data=body, headers={'X-Signature': sign(body)})
+    assert resp.status_code == 200
+    assert exchange.orders == [('buy', 'ETHUSDT', 0.5, {'reduceOnly': True})]
+
+
+def test_secret_is_not_logged(client, monkeypatch):
+    messages = []
+    monkeypatch.setattr(bot.logger, "info", lambda msg, *args: messages.append(msg % args))
+    client.post('/webhook', data=orjson.dumps({'secret': 's3cret', 'symbol': 'ETHUSDT', 'side': 'sell'}))
+    assert any('ETHUSDT' in m for m in messages)
+    assert not any('s3cret' in m for m in messages)
+
+
+def test_invalid_qty_pct_is_rejected(client):
+    resp = client.post('/webhook', data=orjson.dumps({'secret': 's3cret', 'symbol': 'ETHUSDT', 'side': 'buy', 'qty_pct': 'ten'}))
+    assert resp.status_code == 400
+
+
+def test_duplicate_alert_is_dropped(client, exchange, fake_redis, monkeypatch):
+    monkeypatch.setattr(bot, "order_queue", None)
+    body = orjson.dumps({'secret': 's3cret', 'symbol': 'ETHUSDT', 'side': 'buy', 'qty_pct': 10})
+    assert client.post('/webhook', data=body).status_code == 200
+    resp = client.post('/webhook', data=body)
+    assert resp.get_json() == {'status': 'dup'}
+    assert len(exchange.orders) == 1
+
+
+def test_alert_is_queued_when_redis_is_configured(client, exchange, fake_redis, monkeypatch):
+    queue = Queue("orders", connection=fake_redis)
+    monkeypatch.setattr(bot, "order_queue", queue)
+    resp = client.post('/webhook', data=orjson.dumps({'secret': 's3cret', 'symbol': 'ETHUSDT', 'action': 'close'}))
+    assert resp.status_code == 202
+    job = queue.fetch_job(resp.get_json()['job'])
+    assert job.func is bot.order_job
+    assert job.args == ('close', 'ETHUSDT')
+    assert job.ttl == bot.ORDER_QUEUE_TTL
+    assert exchange.orders == []
+
+
+def test_order_job_raises_on_failed_order(exchange, monkeypatch):
+    monkeypatch.setattr(bot, "r", None)
+    exchange.free_usdt = 0
+    with pytest.raises(bot.OrderFailed, match="Insufficient balance"):
+        bot.order_job('buy', 'ETHUSDT', 10)
+
+
+# --- Price stream ---
+
+def test_unknown_symbols_are_not_streamed(exchange):
+    bot.watch_price('ETHUSDTT')
+    assert 'ETHUSDTT' not in bot.watched_symbols
+    assert bot.price_loop is None